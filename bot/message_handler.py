@@ -1,45 +1,143 @@
 import aiohttp
-import io
-import random
+import asyncio
+import logging
 import os
+import uuid
 import yaml
 
+from collections import OrderedDict
+from functools import lru_cache, partial
 from aiogram import F
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters.command import Command
-from aiogram.types import FSInputFile, Message
-from PIL import Image
+from aiogram.types import BufferedInputFile, Message
 # from bot.user_logger import log_user
 
 
+logger = logging.getLogger(__name__)
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # repo root, where temp/ lives
+HTTP_SESSION = None  # shared between handlers, created on startup
+BACKGROUND_TASKS = set()  # keeps fire-and-forget tasks referenced until they finish
+IMAGE_SEM = None  # face extractions in flight, created on startup inside the running loop
+TG_SEND_LIMIT = 30  # Telegram's bot-wide limit of outgoing messages per second
+TG_SEND_SEM = None  # created on startup, like IMAGE_SEM
+TG_SEND_RETRIES = 3  # flood control retries before the error reaches the handler
+tg_paused_until = 0.0  # event loop time when flood control lets us send again
+FACE_FILE_IDS = OrderedDict()  # file_unique_id of a user's photo -> Telegram file_id of its face, oldest first
+FACE_FILE_IDS_SIZE = int(os.getenv('FACE_CACHE_SIZE', '10000'))  # two short id strings per entry, ~3 MB when full
+
+
+def get_session():
+    global HTTP_SESSION
+    if HTTP_SESSION is None or HTTP_SESSION.closed:
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=30, ttl_dns_cache=300, keepalive_timeout=75)
+        HTTP_SESSION = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar(),
+                                             timeout=aiohttp.ClientTimeout(total=60))
+    return HTTP_SESSION
+
+
+async def on_startup():
+    global IMAGE_SEM, TG_SEND_SEM
+    IMAGE_SEM = asyncio.Semaphore(int(os.getenv('IMAGE_CONCURRENCY', '2')))
+    TG_SEND_SEM = asyncio.Semaphore(TG_SEND_LIMIT)
+    get_session()
+
+
+async def on_shutdown():
+    if HTTP_SESSION is not None:
+        await HTTP_SESSION.close()
+
+
+@lru_cache(maxsize=None)
 def get_contacts():
-    with open('bot/contacts.yaml', 'r') as f:
-        config = yaml.safe_load(f)
+    with open(os.path.join(os.path.dirname(__file__), 'contacts.yaml'), 'r') as f:
+        config = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
     return config
 
 
-def generate_filename(folder='original'):
-    while True:
-        filename = os.path.join('temp/'+folder, f'img_{random.randint(1, 999999)}.png')
-        if not os.path.exists(filename):
-            return filename
+@lru_cache(maxsize=None)
+def get_contacts_text():
+    contacts = get_contacts()
+    return f"Reach me out through:\nTelegram: @{contacts['telegram']}\nGithub: {contacts['github']}\n"
+
+
+def generate_filename(folder='original', ext='.png'):
+    return os.path.join(BASE_DIR, 'temp', folder, f'img_{uuid.uuid4().hex}{ext}')
+
+
+def run_in_background(coro):
+    task = asyncio.ensure_future(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    task.add_done_callback(log_task_error)
+    return task
+
+
+def log_task_error(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('Background task failed', exc_info=task.exception())
+
+
+async def acquire_send_slot():
+    """Wait out flood control, then take one of the bot-wide per-second send slots"""
+    loop = asyncio.get_running_loop()
+    while tg_paused_until > loop.time():
+        await asyncio.sleep(tg_paused_until - loop.time())
+    await TG_SEND_SEM.acquire()
+    loop.call_later(1, TG_SEND_SEM.release)
+
+
+async def send(method, *args, **kwargs):
+    """Call a Telegram send method within the bot-wide rate limit, retrying after flood control"""
+    global tg_paused_until
+    loop = asyncio.get_running_loop()
+    for attempt in range(TG_SEND_RETRIES + 1):
+        await acquire_send_slot()
+        try:
+            return await method(*args, **kwargs)
+        except TelegramRetryAfter as e:
+            if attempt == TG_SEND_RETRIES:
+                raise
+            logger.warning('Flood control exceeded, pausing sends for %s seconds', e.retry_after)
+            tg_paused_until = max(tg_paused_until, loop.time() + e.retry_after)
+
+
+def remember_face(unique_id, file_id):
+    FACE_FILE_IDS[unique_id] = file_id
+    FACE_FILE_IDS.move_to_end(unique_id)
+    if len(FACE_FILE_IDS) > FACE_FILE_IDS_SIZE:
+        FACE_FILE_IDS.popitem(last=False)
+
+
+async def relay_chunks(response, chunks, chunk_size=1 << 16):
+    """Pass a download through to an upload, keeping a copy of what went by"""
+    async for chunk in response.content.iter_chunked(chunk_size):
+        chunks.append(chunk)
+        yield chunk
+
+
+def save_image(raw, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(raw)
 
 
 async def handle_start(message):
-    await message.answer("Welcome! Send me a photo of a person and I will return their face.")
+    await send(message.answer, "Welcome! Send me a photo of a person and I will return their face.")
 
 
 async def handle_support(message):
-    user = await user_contacts(message.from_user)
-    await message.bot.send_message(get_contacts()['my_id'], f'User: {user} requires help')
-    await message.answer("Request has been sent to the administrator. You'll be contacted. Probably")
+    user = user_contacts(message.from_user)
+    await send(message.bot.send_message, get_contacts()['my_id'], f'User: {user} requires help',
+               parse_mode=None, disable_web_page_preview=True)
+    await send(message.answer, "Request has been sent to the administrator. You'll be contacted. Probably")
 
-async def user_contacts(m):
-    return f'ids:{m.id} @{m.username} {m.url}\nname: {m.first_name} {m.last_name} {m.full_name}'
+def user_contacts(m):
+    return f'ids:{m.id} @{m.username or ""} {m.url}\nname: {m.first_name} {m.last_name or ""} {m.full_name}'
 
 
 async def handle_contacts(message):
-    contacts = get_contacts()
-    await message.answer(f"Reach me out through:\nTelegram: @{contacts['telegram']}\nGithub: {contacts['github']}\n")
+    await send(message.answer, get_contacts_text())
 
 
 async def handle_help(message):
@@ -50,72 +148,79 @@ async def handle_help(message):
         "/contacts - Show contacts list\n"
         "/support - send a support request\n"
         "Send me a photo, and I'll process it!")
-    await message.answer(help_message)
+    await send(message.answer, help_message)
+
+
+async def fetch_face(file_url, chunks, face_extraction_url='http://localhost:8000/extract_face'):
+    """Stream a photo from Telegram to the extraction backend; returns the face or an error reply"""
+    session = get_session()
+    async with IMAGE_SEM, session.get(file_url) as download:
+        if download.status != 200:
+            error_message = await download.text()
+            logger.warning('Image download failed: %s', error_message)
+            return None, 'Failed to download image. Please try again'
+        dataform = aiohttp.FormData()
+        dataform.add_field('file', relay_chunks(download, chunks), filename='image.png', content_type='image/png')
+        async with session.post(face_extraction_url, data=dataform) as response:
+            # {'file':('image.jpg', content, 'image/jpeg')}) as response:
+            logger.info('Sending image through fastapi')
+            if response.status != 200:
+                error_message = await response.text()
+                logger.warning('Face extraction failed: %s', error_message)
+                return None, 'Failed to process image. Please try again'
+            return await response.read(), None
 
 
 async def handle_image(message: Message, token):
-    face_extraction_url = 'http://localhost:8000/extract_face'
-    file_path = await message.bot.get_file(message.photo[-1].file_id)
+    photo = message.photo[-1]
+    face_file_id = FACE_FILE_IDS.get(photo.file_unique_id)
+    if face_file_id is not None:
+        FACE_FILE_IDS.move_to_end(photo.file_unique_id)
+        try:
+            await send(message.answer_photo, photo=face_file_id)
+            return
+        except TelegramBadRequest as e:
+            logger.warning('Cached face file_id rejected, extracting again: %s', e)
+            FACE_FILE_IDS.pop(photo.file_unique_id, None)
+
+    file_path = await message.bot.get_file(photo.file_id)
     file_url = f"https://api.telegram.org/file/bot{token}/{file_path.file_path}"
-    output = generate_filename('result')
+    ext = os.path.splitext(file_path.file_path)[1] or '.jpg'
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(file_url) as response:
-                if response.status == 200:
-                    print('Image downloaded')
-                    content = await response.read()
-                else:
-                    error_message = await response.text()
-                    print(error_message)
-                    await message.answer('Failed to download image. Please try again')
-                    return
-            dataform = aiohttp.FormData()
-            dataform.add_field('file', content, filename='image.png', content_type='image/png')
-            async with session.post(face_extraction_url, data=dataform) as response:
-                # {'file':('image.jpg', content, 'image/jpeg')}) as response:
-                print('Sending image through fastapi')
-                if response.status == 200:
-                    image_data = await response.read()
-
-                    orig = Image.open(io.BytesIO(content))
-                    orig.save(generate_filename(), format='PNG')
-
-                    imgfile = Image.open(io.BytesIO(image_data))
-                    imgfile.save(output, format='PNG')
-
-                    inp_file = FSInputFile(output)
-                    await message.answer_photo(photo=inp_file)
-
-                    #  os.remove(output)
-                    print('Image sent')
-                else:
-                    error_message = await response.text()
-                    print(error_message)
-                    await message.answer('Failed to process image. Please try again')
-                    return
+        chunks = []
+        image_data, error_reply = await fetch_face(file_url, chunks)
+        if image_data is None:
+            await send(message.answer, error_reply)
+            return
+        content = b''.join(chunks)
+
+        run_in_background(asyncio.get_running_loop().run_in_executor(None, save_image, content, generate_filename(ext=ext)))
+
+        sent = await send(message.answer_photo, photo=BufferedInputFile(image_data, filename='face.png'))
+        remember_face(photo.file_unique_id, sent.photo[-1].file_id)
+        logger.info('Image sent')
 
     except Exception as e:
-        print(e)    # TODO: log it
-        await message.answer('Sorry must have been an error. Try again later.')
+        logger.exception('Failed to process image: %s', e)
+        await send(message.answer, 'Sorry must have been an error. Try again later.')
 
 
 async def handle_text(message: Message):
-    text = await user_contacts(message.from_user)
-    print(f'User:{text}\nsaid:\t{message.text}')
+    text = user_contacts(message.from_user)
+    logger.info('User:%s\nsaid:\t%s', text, message.text)
     response_text = (
         "I'm currently set up to process photos only. "
         "Please send me a photo of a person, and I will return their face.")
-    await message.answer(response_text)
+    await send(message.answer, response_text)
 
 
 def setup_handlers(dp, bot_token):
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
     dp.message(Command('start'))(handle_start)
     dp.message(Command('help'))(handle_help)
     dp.message(Command('contacts'))(handle_contacts)
     dp.message(Command('support'))(handle_support)
-
-    async def image_handler(message: Message):
-        await handle_image(message, bot_token)
-    dp.message(F.photo)(image_handler)
+    dp.message(F.photo)(partial(handle_image, token=bot_token))
     dp.message(F.text)(handle_text)
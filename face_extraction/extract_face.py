@@ -1,17 +1,28 @@
 import cv2
 import numpy as np
 from PIL import Image, ImageFont, ImageDraw, ImageOps
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from fastapi import FastAPI, UploadFile, File
-from tempfile import NamedTemporaryFile
-import os
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from collections import OrderedDict
+from functools import lru_cache
+import asyncio
+import hashlib
 import io
+import logging
+import os
 from ultralytics import YOLO
 import torch
 
 
+logger = logging.getLogger(__name__)
 file_db = {}  # TODO: change for real db
+result_cache = OrderedDict()  # upload digest -> extracted face file, oldest first
+RESULT_CACHE_SIZE = 256
+in_flight = {}  # upload digest -> task extracting that face right now
+results_dir = TemporaryDirectory(prefix='extract_face_')  # removed as a whole on shutdown
 app = FastAPI()
 app.add_middleware(CORSMiddleware,
                    allow_origins=["*"],  # Allows all origins
@@ -20,6 +31,91 @@ app.add_middleware(CORSMiddleware,
                    allow_headers=["*"],)  # Allows all headers
 
 
+class DynamicBatcher:
+    """Groups segmentation requests that queue up while the model is busy into one model call"""
+    def __init__(self, max_batch_size=8):
+        self.max_batch_size = max_batch_size
+        self.queue = None
+        self.worker = None
+        self.batch = []  # requests taken off the queue and not answered yet
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.worker is None:
+            return
+        pending = self.batch + [self.queue.get_nowait() for _ in range(self.queue.qsize())]
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(RuntimeError('Face extraction is shutting down'))
+        self.worker.cancel()
+
+    async def predict(self, image):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, future))
+        return await future
+
+    async def collect(self):
+        self.batch = [await self.queue.get()]
+        while len(self.batch) < self.max_batch_size and not self.queue.empty():
+            self.batch.append(self.queue.get_nowait())
+        return self.batch
+
+    async def predict_each(self, images):
+        """Retry a failed batch one image at a time so a bad upload only fails its own request"""
+        results = []
+        for image in images:
+            try:
+                results.extend(await run_in_threadpool(predict_batch, get_seg_model(), [image]))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def run(self):
+        while True:
+            batch = await self.collect()
+            images = [image for image, _ in batch]
+            try:
+                results = await run_in_threadpool(predict_batch, get_seg_model(), images)
+            except Exception as e:
+                results = await self.predict_each(images) if len(batch) > 1 else [e]
+            for (_, future), masks in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(masks, Exception):
+                    future.set_exception(masks)
+                else:
+                    future.set_result(masks)
+            self.batch = []
+
+
+batcher = DynamicBatcher()
+
+
+@app.on_event("startup")
+def load_models():
+    get_seg_model()
+    get_base_image('mona_lisa.png')
+
+
+@app.on_event("startup")
+async def start_batcher():
+    batcher.start()
+
+
+@app.on_event("shutdown")
+async def stop_batcher():
+    await batcher.stop()
+
+
+@app.on_event("shutdown")
+async def remove_results():
+    result_cache.clear()
+    await run_in_threadpool(results_dir.cleanup)
+
+
 @app.get("/images/{file_id}")  # for tests
 async def get_image(file_id: str):
     file_path = file_db.get(file_id)
@@ -30,31 +126,90 @@ async def get_image(file_id: str):
 
 @app.post('/extract_face')
 async def extract_face(file: UploadFile = File(...)):
-    with NamedTemporaryFile(delete=False, suffix='.jpg') as tempfile:
-        contents = await file.read()
-        tempfile.write(contents)
+    contents = await file.read()
+    key = hashlib.blake2b(contents, digest_size=16).hexdigest()
+    new_filename = get_cached_result(key)
+    if new_filename is None:
+        new_filename = await extract_once(key, contents)
+
+    return FileResponse(new_filename, media_type="image/png")
+
+
+async def extract_once(key, contents):
+    """Concurrent uploads of the same image share a single extraction"""
+    task = in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(run_extraction(key, contents))
+        in_flight[key] = task
+        task.add_done_callback(lambda _: in_flight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def run_extraction(key, contents):
+    image = await run_in_threadpool(load_upload, contents)
+    masks = await batcher.predict(image)
+    new_filename = await run_in_threadpool(save_result, image, masks)
+    await cache_result(key, new_filename)
+    return new_filename
+
+
+def load_upload(contents):
+    return Image.open(io.BytesIO(contents)).convert('RGB')
+
+
+def save_result(image, masks):
+    """Render the face into a new file in results_dir, leaving nothing behind if that fails"""
+    with NamedTemporaryFile(delete=False, suffix='_modified.png', dir=results_dir.name) as tempfile:
+        new_filename = tempfile.name
+    try:
+        save_face(image, masks, new_filename)
+    except Exception:
+        os.remove(new_filename)
+        raise
+    return new_filename
+
+
+def get_cached_result(key):
+    path = result_cache.get(key)
+    if path is not None:
+        result_cache.move_to_end(key)
+    return path
+
+
+async def cache_result(key, path):
+    result_cache[key] = path
+    result_cache.move_to_end(key)
+    while len(result_cache) > RESULT_CACHE_SIZE:
+        _, old_path = result_cache.popitem(last=False)
+        await run_in_threadpool(remove_result, old_path)
+
+
+def remove_result(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
-    filename = tempfile.name
-    new_filename = filename.replace('.jpg', '_modified.png')
 
-    await get_face(filename, new_filename)
+@lru_cache(maxsize=None)
+def get_seg_model(weights='seg_models/heads_weights.pt'):
+    return YOLO(weights)
 
-    #  TODO: could just send Image file
-    img = Image.open(new_filename)
-    img_byte_arr = io.BytesIO()
-    img.save(img_byte_arr, format='PNG')
-    img_byte_arr = img_byte_arr.getvalue()
-    return StreamingResponse(io.BytesIO(img_byte_arr), media_type="image/png")
 
+@lru_cache(maxsize=None)
+def get_base_image(path):
+    with Image.open(path) as base_image:
+        return base_image.copy()
 
 
-def predict(model, img, size=(640, 640)):
-    image_tensor = torch.from_numpy(np.array(img.resize(size))).float().div(255).permute(2, 0, 1).unsqueeze(0)
-    prediction = model(image_tensor)
-    return prediction[0].masks
+def predict_batch(model, imgs, size=(640, 640)):
+    batch = torch.stack([torch.from_numpy(np.array(img.resize(size))).float().div(255).permute(2, 0, 1)
+                         for img in imgs])
+    predictions = model(batch)
+    return [prediction.masks for prediction in predictions]
 
 
-async def resize_image_preserve_aspect_ratio(image, size):
+def resize_image_preserve_aspect_ratio(image, size):
     width, height = image.size
     aspect_ratio = width / height
 
@@ -66,7 +221,7 @@ async def resize_image_preserve_aspect_ratio(image, size):
         new_width = int(new_height * aspect_ratio)
     return image.resize((new_width, new_height))
 
-async def get_seg_mask_2(img, combi_mask, size=(240, 260)):
+def get_seg_mask_2(img, combi_mask, size=(240, 260)):
     image_rgba = img.convert("RGBA")
     data = np.array(image_rgba)
     alpha_channel = (combi_mask * 255).astype(np.uint8)
@@ -74,23 +229,22 @@ async def get_seg_mask_2(img, combi_mask, size=(240, 260)):
     masked_image = Image.fromarray(data)
     bbox = masked_image.getbbox()
     if bbox:
-        resized_image =  await resize_image_preserve_aspect_ratio(masked_image.crop(bbox), size)
+        resized_image = resize_image_preserve_aspect_ratio(masked_image.crop(bbox), size)
         result_image = Image.new("RGBA", size)
         x_offset = (size[0] - resized_image.width) // 2
         y_offset = (size[1] - resized_image.height) // 2
         result_image.paste(resized_image, (x_offset, y_offset))
-        result_image.save('face.png')
         return result_image
     else:
         return masked_image
 
-async def apply_mask_to_image(img, masks, coordinates=(191, 83), base_image_path='mona_lisa.png'):
+def apply_mask_to_image(img, masks, coordinates=(191, 83), base_image_path='mona_lisa.png'):
     first_mask = masks[0].data[0].cpu().numpy()
     mask_resized = cv2.resize(first_mask, (img.width, img.height), interpolation=cv2.INTER_NEAREST)
-    seg_img = await get_seg_mask_2(img, mask_resized)
-    with Image.open(base_image_path) as mona_lisa:
-        mona_lisa.paste(seg_img, coordinates, seg_img)
-        return mona_lisa
+    seg_img = get_seg_mask_2(img, mask_resized)
+    mona_lisa = get_base_image(base_image_path).copy()
+    mona_lisa.paste(seg_img, coordinates, seg_img)
+    return mona_lisa
 
     #seg_img.show()
     return seg_img
@@ -134,14 +288,10 @@ def get_no_face(original_image):
     return white_canvas
 
 
-async def get_face(temp_file, new_file):
-    weights = 'seg_models/heads_weights.pt'
-    seg_model = YOLO(weights)
-    image = Image.open(temp_file)
-    masks = predict(seg_model, image)
-    segmented_img =  await apply_mask_to_image(image,masks) if masks else get_no_face(image)# cutout(image, masks) if masks else get_no_face(image)
+def save_face(image, masks, new_file):
+    segmented_img = apply_mask_to_image(image,masks) if masks else get_no_face(image)# cutout(image, masks) if masks else get_no_face(image)
     segmented_img.save(new_file, format="PNG")
-    print('new file saved')
+    logger.debug('Face saved to %s', new_file)
     return segmented_img
 
 
@@ -1,6 +1,9 @@
 import asyncio
 import logging
+import os
+import queue
 import yaml
+from logging.handlers import QueueHandler, QueueListener
 from aiogram import Bot, Dispatcher
 from bot.message_handler import setup_handlers
 
@@ -11,14 +14,26 @@ async def main(dp, iobot):
 
 
 def get_token():
-    with open('config.yaml', 'r') as f:
-        config = yaml.safe_load(f)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml'), 'r') as f:
+        config = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
     return config['token']
 
 
+def setup_logging():
+    """Handlers only enqueue records, the listener thread does the actual writing"""
+    log_queue = queue.Queue(-1)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO,
+                        handlers=[QueueHandler(log_queue)])
+    return QueueListener(log_queue, logging.StreamHandler())
+
+
 if __name__ == '__main__':
-    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    listener = setup_logging()
+    listener.start()
 
     ibot = Bot(token=get_token())
     dispatcher = Dispatcher()
-    asyncio.run(main(dispatcher, ibot))
+    try:
+        asyncio.run(main(dispatcher, ibot))
+    finally:
+        listener.stop()